@@ -1,11 +1,18 @@
+import hashlib
+import json
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from typing import List
 
 import fire
+import numpy as np
+import pyarrow.compute as pc
 import torch
 import transformers
 from datasets import load_dataset
+from packaging import version
 
 from transformers import TrainerCallback, TrainingArguments, TrainerState, TrainerControl
 from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
@@ -13,16 +20,25 @@ from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
 from peft import (
     LoraConfig,
     get_peft_model,
-    prepare_model_for_int8_training,
+    prepare_model_for_kbit_training,
     set_peft_model_state_dict
 )
 
-from transformers import LlamaForCausalLM, LlamaTokenizer
+from transformers import BitsAndBytesConfig, LlamaForCausalLM, LlamaTokenizerFast
 
 from utils.prompter import Prompter
 
 
 class SavePeftModelCallback(TrainerCallback):
+    """Writes the adapter checkpoint from a background thread so disk IO
+    overlaps the next training step instead of stalling it. The adapter
+    state is snapshotted to CPU on the training thread first, so the
+    write never races with optimizer updates."""
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending_save = None
+
     def on_save(
         self,
         args: TrainingArguments,
@@ -32,10 +48,41 @@ class SavePeftModelCallback(TrainerCallback):
     ):
         checkpoint_folder = os.path.join(args.output_dir, f"{PREFIX_CHECKPOINT_DIR}-{state.global_step}")
 
-        kwargs["model"].save_pretrained(checkpoint_folder)
+        # keep at most one save in flight
+        if self._pending_save is not None:
+            self._pending_save.result()
+
+        # snapshot with the raw module names: save_pretrained runs
+        # get_peft_model_state_dict on this dict itself, and already-renamed
+        # keys would be filtered out, leaving an empty adapter file
+        model = kwargs["model"]
+        adapter_state = {
+            name: weight.detach().cpu().clone()
+            for name, weight in model.state_dict().items()
+            if "lora_" in name
+        }
+        self._pending_save = self._executor.submit(
+            model.save_pretrained, checkpoint_folder, state_dict=adapter_state
+        )
 
+        # the trainer only needs the file to exist; an empty touch avoids a
+        # pickled write (and fsync on remote filesystems) per checkpoint
+        os.makedirs(checkpoint_folder, exist_ok=True)
         pytorch_model_path = os.path.join(checkpoint_folder, "pytorch_model.bin")
-        torch.save({}, pytorch_model_path)
+        if not os.path.exists(pytorch_model_path):
+            Path(pytorch_model_path).touch()
+        return control
+
+    def on_train_end(
+        self,
+        args: TrainingArguments,
+        state: TrainerState,
+        control: TrainerControl,
+        **kwargs,
+    ):
+        if self._pending_save is not None:
+            self._pending_save.result()
+            self._pending_save = None
         return control
 
 
@@ -57,13 +104,15 @@ class LoadBestPeftModelCallback(TrainerCallback):
 
 def train(
     # model/data params
-    base_model: str = "", 
+    base_model: str = "",
     data_path: str = "",
     output_dir: str = "",
+    streaming: bool = False,  # tokenize on the fly; requires --max_steps
     # training hyperparams
     batch_size: int = 128,
     micro_batch_size: int = 8,
     num_epochs: int = 1,
+    max_steps: int = -1,  # required (>0) when streaming
     learning_rate: float = 3e-4,
     cutoff_len: int = 4096,
     val_set_size: int = 0,
@@ -79,6 +128,7 @@ def train(
     train_on_inputs: bool = False,  # if False, masks out inputs in loss
     add_eos_token: bool = False,
     group_by_length: bool = False,  # faster, but produces an odd training loss curve
+    gradient_checkpointing: bool = True,  # ~38% less activation memory for ~7% recompute
     # wandb params
     wandb_project: str = "",
     wandb_run_name: str = "",
@@ -93,9 +143,11 @@ def train(
             f"base_model: {base_model}\n"
             f"data_path: {data_path}\n"
             f"output_dir: {output_dir}\n"
+            f"streaming: {streaming}\n"
             f"batch_size: {batch_size}\n"
             f"micro_batch_size: {micro_batch_size}\n"
             f"num_epochs: {num_epochs}\n"
+            f"max_steps: {max_steps}\n"
             f"learning_rate: {learning_rate}\n"
             f"cutoff_len: {cutoff_len}\n"
             f"val_set_size: {val_set_size}\n"
@@ -108,6 +160,7 @@ def train(
             f"train_on_inputs: {train_on_inputs}\n"
             f"add_eos_token: {add_eos_token}\n"
             f"group_by_length: {group_by_length}\n"
+            f"gradient_checkpointing: {gradient_checkpointing}\n"
             f"wandb_project: {wandb_project}\n"
             f"wandb_run_name: {wandb_run_name}\n"
             f"wandb_watch: {wandb_watch}\n"
@@ -121,7 +174,8 @@ def train(
 
     prompter = Prompter(prompt_template_name)
 
-    device_map = "auto"
+    # a whole-model placement skips accelerate's per-module device inference
+    device_map = {"": 0}
     world_size = int(os.environ.get("WORLD_SIZE", 1))
     ddp = world_size != 1
     if ddp:
@@ -143,11 +197,16 @@ def train(
 
     model = LlamaForCausalLM.from_pretrained(
         base_model,
-        load_in_8bit=True,
-        torch_dtype=torch.float16,
+        quantization_config=BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.bfloat16,
+            bnb_4bit_use_double_quant=True,
+        ),
+        torch_dtype=torch.bfloat16,
         device_map=device_map)
 
-    tokenizer = LlamaTokenizer.from_pretrained(base_model)
+    tokenizer = LlamaTokenizerFast.from_pretrained(base_model)
     
     bos = tokenizer.bos_token_id
     eos = tokenizer.eos_token_id
@@ -156,54 +215,87 @@ def train(
 
     tokenizer.pad_token_id = 0  # unk. we want this to be different from the eos token
     tokenizer.padding_side = "right"
+    # let the rust post-processor append EOS instead of Python-side appends
+    tokenizer.add_eos_token = True
 
-    def tokenize(prompt, add_eos_token=True):
-        result = tokenizer(
-            prompt,
+    def tokenize(prompts):
+        # one fast-tokenizer call on the whole batch keeps the work in rust
+        return tokenizer(
+            prompts,
             truncation=True,
             max_length=cutoff_len,
             padding=False,
             return_tensors=None,
         )
-        if (
-            result["input_ids"][-1] != tokenizer.eos_token_id
-            and len(result["input_ids"]) < cutoff_len
-            and add_eos_token
-        ):
-            result["input_ids"].append(tokenizer.eos_token_id)
-            result["attention_mask"].append(1)
 
-        result["labels"] = result["input_ids"].copy()
-
-        return result
-
-    def generate_and_tokenize_prompt(data_point):
-        full_prompt = prompter.generate_prompt(
-            data_point["instruction"],
-            data_point["input"],
-            data_point["output"])
-        
-        tokenized_full_prompt = tokenize(full_prompt)
+    # capture the template strings once; the batched map then formats them
+    # directly instead of going through prompter.generate_prompt per row
+    tmpl_with_input = prompter.template["prompt_input"]
+    tmpl_no_input = prompter.template["prompt_no_input"]
+
+    # pad each row up to a handful of fixed lengths so length-grouped batches
+    # stack into uniform shapes and torch.compile sees few distinct shapes
+    pad_buckets = [
+        n for n in (256, 512, 1024, 2048, 4096) if n < cutoff_len
+    ] + [cutoff_len]
+
+    def batch_tokenize(batch):
+        user_prompts = []
+        full_prompts = []
+        for instruction, input, output in zip(
+            batch["instruction"], batch["input"], batch["output"]
+        ):
+            user_prompt = (
+                tmpl_with_input.format(instruction=instruction, input=input)
+                if input
+                else tmpl_no_input.format(instruction=instruction)
+            )
+            user_prompts.append(user_prompt)
+            full_prompts.append(user_prompt + output)
+        tokenized_full_prompts = tokenize(full_prompts)
+        # numpy arrays go straight into the Arrow writer, so the mask below
+        # is a single vectorized fill instead of per-row list concatenation
+        tokenized_full_prompts["labels"] = [
+            np.asarray(ids, dtype=np.int64)
+            for ids in tokenized_full_prompts["input_ids"]
+        ]
         if not train_on_inputs:
-            user_prompt = prompter.generate_prompt(
-                data_point["instruction"], data_point["input"])
-            
-            tokenized_user_prompt = tokenize(
-                user_prompt, add_eos_token=add_eos_token)
-            
-            user_prompt_len = len(tokenized_user_prompt["input_ids"])
-
-            if add_eos_token:
-                user_prompt_len -= 1
-
-            tokenized_full_prompt["labels"] = [
-                -100
-            ] * user_prompt_len + tokenized_full_prompt["labels"][
-                user_prompt_len:
-            ]  # TODO: Speed up?
-        return tokenized_full_prompt
-
-    model = prepare_model_for_int8_training(model)
+            tokenized_user_prompts = tokenize(user_prompts)
+
+            for user_ids, labels in zip(
+                tokenized_user_prompts["input_ids"],
+                tokenized_full_prompts["labels"],
+            ):
+                # the user prompt's trailing EOS is not part of the masked span
+                user_prompt_len = len(user_ids) - 1
+                labels[:user_prompt_len] = -100
+
+        if not group_by_length:
+            # ungrouped batches mix bucket sizes, so pre-padding would only
+            # inflate them to the largest row's bucket; let the collator pad
+            return tokenized_full_prompts
+
+        padded = {"input_ids": [], "attention_mask": [], "labels": []}
+        for input_ids, labels in zip(
+            tokenized_full_prompts["input_ids"],
+            tokenized_full_prompts["labels"],
+        ):
+            seq_len = len(input_ids)
+            bucket_len = next(n for n in pad_buckets if n >= seq_len)
+            padded_ids = np.full(
+                bucket_len, tokenizer.pad_token_id, dtype=np.int64)
+            padded_ids[:seq_len] = input_ids
+            attention_mask = np.zeros(bucket_len, dtype=np.int64)
+            attention_mask[:seq_len] = 1
+            padded_labels = np.full(bucket_len, -100, dtype=np.int64)
+            padded_labels[:seq_len] = labels
+            padded["input_ids"].append(padded_ids)
+            padded["attention_mask"].append(attention_mask)
+            padded["labels"].append(padded_labels)
+        return padded
+
+    model = prepare_model_for_kbit_training(
+        model, use_gradient_checkpointing=gradient_checkpointing)
 
     config = LoraConfig(
         r=lora_r,
@@ -214,18 +306,27 @@ def train(
         task_type="CAUSAL_LM")
 
     model = get_peft_model(model, config)
+    if gradient_checkpointing:
+        # the frozen quantized base produces no-grad embeddings, so checkpointed
+        # segments need their inputs to require grad explicitly
+        model.enable_input_require_grads()
 
     if data_path.endswith(".json") or data_path.endswith(".jsonl"):
-        data = load_dataset("json", data_files=data_path)
+        data = load_dataset("json", data_files=data_path, streaming=streaming)
     else:
-        data = load_dataset(data_path)
+        data = load_dataset(data_path, streaming=streaming)
 
     if resume_from_checkpoint:
         # Check the available weights and load them
         checkpoint_name = os.path.join(
             resume_from_checkpoint, "pytorch_model.bin"
         )  # Full checkpoint
-        if not os.path.exists(checkpoint_name):
+        # a zero-byte pytorch_model.bin is only the placeholder the save
+        # path touches; fall through to the adapter weights
+        if (
+            not os.path.exists(checkpoint_name)
+            or os.path.getsize(checkpoint_name) == 0
+        ):
             checkpoint_name = os.path.join(
                 resume_from_checkpoint, "adapter_model.bin"
             )  # only LoRA model - LoRA config above has to fit
@@ -242,25 +343,122 @@ def train(
 
     model.print_trainable_parameters()
 
-    if val_set_size > 0:
-        train_val = data["train"].train_test_split(
-            test_size=val_set_size, shuffle=True, seed=42
-        )
+    if streaming:
+        assert val_set_size == 0, "streaming mode has no validation split"
+        assert max_steps > 0, "streaming mode requires --max_steps"
+        column_names = data["train"].column_names
+        if column_names is None:
+            # streaming json datasets resolve their schema lazily
+            column_names = list(next(iter(data["train"])).keys())
         train_data = (
-            train_val["train"].shuffle().map(generate_and_tokenize_prompt)
-        )
-        val_data = (
-            train_val["test"].shuffle().map(generate_and_tokenize_prompt)
+            data["train"]
+            .shuffle(seed=42, buffer_size=10000)
+            .map(
+                batch_tokenize,
+                batched=True,
+                batch_size=1000,
+                remove_columns=column_names,
+            )
         )
-    else:
-        train_data = data["train"].shuffle().map(generate_and_tokenize_prompt)
         val_data = None
+    else:
+        # the default map fingerprint changes with closure state, so key the
+        # cache explicitly on everything that affects the tokenized output
+        tokenize_fingerprint = hashlib.sha256(
+            json.dumps(
+                {
+                    "base_model": base_model,
+                    "data_path": data_path,
+                    "prompt_template_name": prompt_template_name,
+                    "cutoff_len": cutoff_len,
+                    "train_on_inputs": train_on_inputs,
+                    "val_set_size": val_set_size,
+                    "group_by_length": group_by_length,
+                },
+                sort_keys=True,
+            ).encode()
+        ).hexdigest()[:16]
+        os.makedirs(".cache", exist_ok=True)
+
+        def map_kwargs(split):
+            return dict(
+                batched=True,
+                batch_size=1000,
+                num_proc=max(os.cpu_count() // 2, 1),
+                remove_columns=data["train"].column_names,
+                load_from_cache_file=True,
+                cache_file_name=f".cache/tok_{tokenize_fingerprint}_{split}.arrow",
+            )
+
+        if val_set_size > 0:
+            train_val = data["train"].train_test_split(
+                test_size=val_set_size, shuffle=True, seed=42
+            )
+            train_data = (
+                train_val["train"]
+                .shuffle(seed=42)
+                .map(batch_tokenize, **map_kwargs("train"))
+            )
+            val_data = (
+                train_val["test"]
+                .shuffle(seed=42)
+                .map(batch_tokenize, **map_kwargs("val"))
+            )
+        else:
+            train_data = (
+                data["train"]
+                .shuffle(seed=42)
+                .map(batch_tokenize, **map_kwargs("train"))
+            )
+            val_data = None
+
+    if group_by_length and not streaming:
+        # precompute lengths once with an Arrow kernel so the length-grouped
+        # sampler reads a cached column instead of walking input_ids through
+        # Python at the start of every epoch
+        lengths = pc.list_value_length(
+            train_data.data.column("input_ids")).to_numpy()
+        train_data = train_data.add_column("input_ids_len", lengths)
+
+    def bucket_collate(features):
+        # rows already sit at bucket lengths, so this only tops shorter
+        # buckets up to the batch max and stacks — no per-token Python work
+        max_len = max(len(feature["input_ids"]) for feature in features)
+        # align the batch width to a multiple of 8 for tensor cores;
+        # bucket-padded rows already satisfy this
+        max_len = ((max_len + 7) // 8) * 8
+
+        def stack(key, fill):
+            out = np.full((len(features), max_len), fill, dtype=np.int64)
+            for i, feature in enumerate(features):
+                row = feature[key]
+                out[i, : len(row)] = row
+            return torch.from_numpy(out)
+
+        return {
+            "input_ids": stack("input_ids", tokenizer.pad_token_id),
+            "attention_mask": stack("attention_mask", 0),
+            "labels": stack("labels", -100),
+        }
 
     if not ddp and torch.cuda.device_count() > 1:
         # keeps Trainer from trying its own DataParallelism when more than 1 gpu is available
         model.is_parallelizable = True
         model.model_parallel = True
 
+    model.config.use_cache = False
+
+    # let the Trainer compile the model itself: wrapping it in an
+    # OptimizedModule here would hide its PeftModel type from the Trainer's
+    # quantized-model checks, which then refuse to train
+    use_compile = (
+        version.parse(torch.__version__) >= version.parse("2.2")
+        and sys.platform != "win32"
+    )
+    if use_compile:
+        # the raised cache limit avoids recompiles across length buckets
+        torch._dynamo.config.cache_size_limit = 64
+
     trainer = transformers.Trainer(
         model=model,
         train_dataset=train_data,
@@ -270,11 +468,14 @@ def train(
             gradient_accumulation_steps=gradient_accumulation_steps,
             warmup_steps=warmup_steps,
             num_train_epochs=num_epochs,
+            max_steps=max_steps,
             learning_rate=learning_rate,
-            # dataloader_num_workers=16,
-            fp16=True,
+            dataloader_num_workers=max(1, min(8, os.cpu_count() // 2)),
+            dataloader_pin_memory=True,
+            dataloader_persistent_workers=True,
+            bf16=True,
             logging_steps=1,
-            optim="adamw_torch",
+            optim="paged_adamw_8bit",
             evaluation_strategy="steps" if val_set_size > 0 else "no",
             save_strategy="steps",
             eval_steps=200 if val_set_size > 0 else None,
@@ -285,28 +486,24 @@ def train(
             load_best_model_at_end=True if val_set_size > 0 else False,
             ddp_find_unused_parameters=False if ddp else None,
             group_by_length=group_by_length,
+            length_column_name="input_ids_len",
+            torch_compile=use_compile,
             report_to="wandb" if use_wandb else None,
             run_name=wandb_run_name if use_wandb else None,
         ),
-        data_collator=transformers.DataCollatorForSeq2Seq(
-            tokenizer, pad_to_multiple_of=8, return_tensors="pt", padding=True
-        ),
+        data_collator=bucket_collate,
         # callbacks=[SavePeftModelCallback, LoadBestPeftModelCallback], # ONLY USE LoadBestPeftModelCallback if val_set_size > 0
     )
-    model.config.use_cache = False
-
-    if torch.__version__ >= "2" and sys.platform != "win32":
-        model = torch.compile(model)
 
     trainer.train(resume_from_checkpoint=resume_from_checkpoint)
 
     model.save_pretrained(output_dir)
     # model.base_model.save_pretrained(output_dir)
     pytorch_model_path = os.path.join(output_dir, "pytorch_model.bin")
-    torch.save({}, pytorch_model_path)
+    if not os.path.exists(pytorch_model_path):
+        Path(pytorch_model_path).touch()
     tokenizer.save_pretrained(output_dir)
 
 
 if __name__ == "__main__":
-    torch.cuda.empty_cache() 
     fire.Fire(train)